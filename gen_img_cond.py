@@ -19,26 +19,165 @@ from torch.utils.tensorboard import SummaryWriter
 from kmeans_pytorch import kmeans, kmeans_predict
 from joblib import load
 import torch
+from concurrent.futures import ThreadPoolExecutor
 
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
+torch.backends.cudnn.benchmark = True
 
+# PNG encoding runs on background threads so the GPU can move on to the next iteration
+executor = ThreadPoolExecutor(max_workers=4)
+pending_writes = []
 
 
 
 
 
 
-def mask_by_random_topk(mask_len, probs, temperature=1.0):
-    mask_len = mask_len.squeeze()
-    confidence = torch.log(probs) + torch.Tensor(temperature * np.random.gumbel(size=probs.shape)).cuda()
-    sorted_confidence, _ = torch.sort(confidence, axis=-1)
-    # Obtains cut off threshold given the mask lengths.
-    cut_off = sorted_confidence[:, mask_len.long()-1:mask_len.long()]
+
+class _Buffers:
+    # Device tensors reused across gen_image calls (and stable addresses for CUDA graph replay)
+    def __init__(self, bsz, seq_len, emb_dim, device):
+        self.token_indices = torch.empty((bsz, seq_len), dtype=torch.long, device=device)
+        self.prev_token_indices = torch.empty((bsz, seq_len), dtype=torch.long, device=device)
+        self.token_drop_mask = torch.zeros((bsz, seq_len), dtype=torch.long, device=device)
+        self.token_all_mask = torch.empty((bsz, seq_len), dtype=torch.bool, device=device)
+        self.input_embeddings = torch.empty((bsz, seq_len, emb_dim), device=device)
+
+
+_buffers = {}
+
+
+def get_buffers(bsz, seq_len, emb_dim, device):
+    key = (bsz, seq_len, emb_dim, str(device))
+    if key not in _buffers:
+        # created as normal tensors (not inference tensors) so in-place updates work whether
+        # gen_image runs under inference_mode or no_grad
+        with torch.inference_mode(False), torch.no_grad():
+            _buffers[key] = _Buffers(bsz, seq_len, emb_dim, device)
+    return _buffers[key]
+
+
+def mask_by_random_topk(mask_len, log_probs, temperature=1.0):
+    mask_len = int(mask_len.item())
+    # Gumbel(0, 1) noise generated on device: -log(E), E ~ Exp(1)
+    gumbel = torch.empty_like(log_probs).exponential_().log_().neg_()
+    confidence = log_probs + temperature * gumbel
+    # Obtains cut off threshold given the mask lengths (k-th smallest confidence).
+    cut_off = torch.topk(confidence, mask_len, dim=-1, largest=False).values[:, -1:]
     # Masks tokens with lower confidence.
     masking = (confidence <= cut_off)
     return masking
 
 
-def gen_image(model, image, bsz, seed, num_iter=12, choice_temperature=4.5,per_iter=False,with_mask_vis=True,data_used='coco',slot_vis=True):
+def _save_png(img, path, params=(), copy_done=None):
+    # img: [H, W, 3] uint8 BGR, possibly still being filled by an async D2H copy
+    if copy_done is not None:
+        copy_done.synchronize()
+    cv2.imwrite(path, img, params)
+
+
+def save_images_async(images, paths, vis_format=None):
+    # Scale/clamp/cast, RGB->BGR and CHW->HWC as one torch op chain on the images' device,
+    # stage the uint8 batch in pinned host memory with a single async copy,
+    # then hand the per-image encode/write to the executor.
+    # vis_format ('png' or 'jpg') marks visualization-only outputs, which trade quality for encode speed.
+    params = ()
+    if vis_format == 'jpg':
+        paths = [os.path.splitext(path)[0] + '.jpg' for path in paths]
+        params = [cv2.IMWRITE_JPEG_QUALITY, 85]
+    elif vis_format == 'png':
+        params = [cv2.IMWRITE_PNG_COMPRESSION, 1]
+    images = images.mul(255).clamp_(0, 255).to(torch.uint8).flip(1).permute(0, 2, 3, 1).contiguous()
+    copy_done = None
+    if images.is_cuda:
+        images_cpu = torch.empty(images.shape, dtype=images.dtype, pin_memory=True)
+        images_cpu.copy_(images, non_blocking=True)
+        # the workers wait for this copy only, not for the rest of the queued GPU work
+        copy_done = torch.cuda.Event()
+        copy_done.record()
+    else:
+        images_cpu = images
+    for b_id, path in enumerate(paths):
+        pending_writes.append(executor.submit(_save_png, images_cpu[b_id].numpy(), path, params, copy_done))
+
+
+def wait_for_writes():
+    # re-raise any error from the background writes
+    for future in pending_writes:
+        future.result()
+    pending_writes.clear()
+
+
+def decode_tokens(model, token_ids, codebook_emb_dim=256, micro_batch=None):
+    # VQGAN decode of [B, 256] token ids to [B, 3, 256, 256] images, optionally in
+    # micro-batches to bound peak memory (as in diffusers' enable_vae_slicing)
+    bsz = token_ids.size(0)
+    micro_batch = micro_batch or bsz
+    gen_images = []
+    for start in range(0, bsz, micro_batch):
+        ids = token_ids[start:start + micro_batch]
+        z_q = model.vqgan.quantize.get_codebook_entry(ids, shape=(ids.size(0), 16, 16, codebook_emb_dim))
+        z_q = z_q.contiguous(memory_format=torch.channels_last)
+        gen_images.append(model.vqgan.decode(z_q))
+    gen_images = torch.cat(gen_images, dim=0) if len(gen_images) > 1 else gen_images[0]
+    # back to fp32 for saving (numpy has no bf16)
+    return gen_images.float()
+
+
+def update_token_embeddings(token_emb, input_embeddings, token_indices, prev_token_indices):
+    # Only re-embed the positions whose token changed since the previous step.
+    batch_ids, pos_ids = (token_indices != prev_token_indices).nonzero(as_tuple=True)
+    if batch_ids.numel() == 0:
+        return input_embeddings
+    input_embeddings[batch_ids, pos_ids] = token_emb.embed_positions(token_indices[batch_ids, pos_ids], pos_ids)
+    return input_embeddings
+
+
+def prefetch_to_cuda(loader):
+    # Yields the loader's batches with the image (first element) already on the GPU. The H2D copy
+    # of batch n+1 is issued on a side stream while batch n is being generated.
+    copy_stream = torch.cuda.Stream()
+
+    def _to_cuda(data):
+        with torch.cuda.stream(copy_stream):
+            return [data[0].cuda(non_blocking=True)] + list(data[1:])
+
+    it = iter(loader)
+    try:
+        next_data = _to_cuda(next(it))
+    except StopIteration:
+        return
+    for data in it:
+        torch.cuda.current_stream().wait_stream(copy_stream)
+        cur_data = next_data
+        cur_data[0].record_stream(torch.cuda.current_stream())
+        next_data = _to_cuda(data)
+        yield cur_data
+    torch.cuda.current_stream().wait_stream(copy_stream)
+    next_data[0].record_stream(torch.cuda.current_stream())
+    yield next_data
+
+
+def make_decode_step(model, compile=False):
+    # One iteration of the generation loop: encoder blocks + norm + slot-conditioned decoder.
+    # Shapes are static ([B, 257, D] tokens, fixed slots), so under torch.compile the
+    # "reduce-overhead" mode fuses the pointwise ops and replays the step as a CUDA graph.
+    def decode_step(input_embeddings, slots, token_drop_mask, token_all_mask, slot_kv=None):
+        x = input_embeddings
+        for blk in model.blocks:
+            x = blk(x)
+        x = model.norm(x)
+        logits, _ = model.forward_decoder(x, slots, token_drop_mask, token_all_mask, slot_kv=slot_kv)
+        return logits
+
+    if compile:
+        decode_step = torch.compile(decode_step, mode="reduce-overhead")
+    return decode_step
+
+
+def gen_image(model, image, bsz, seed, num_iter=12, choice_temperature=4.5,per_iter=False,with_mask_vis=False,data_used='coco',slot_vis=True,decode_step=None,
+              decode_every_k=None,decode_batch_size=None):
     torch.manual_seed(seed)
     np.random.seed(seed)
     codebook_emb_dim = 256
@@ -52,7 +191,7 @@ def gen_image(model, image, bsz, seed, num_iter=12, choice_temperature=4.5,per_i
     else:
         device = torch.device('cpu')
 
-    image=image.cuda()
+    image=image.cuda(non_blocking=True)
 
     # Assuming you've saved the cluster centers as 'cluster_centers.pth'
     # cluster_centers = torch.load('cluster_centers.pth')
@@ -96,7 +235,7 @@ def gen_image(model, image, bsz, seed, num_iter=12, choice_temperature=4.5,per_i
             vis_recon = visualize(image_int, true_mask_c, pred_dec_mask, rgb_dec_attns, pred_default_mask, rgb_default_attns, N=32)
             grid = vutils.make_grid(vis_recon, nrow=2*7 + 4, pad_value=0.2)[:, 2:-2, 2:-2]#anti gia 7 num_slots
             grid = F.interpolate(grid.unsqueeze(1), scale_factor=0.15, mode='bilinear').squeeze() # Lower resolution
-            log_writer.add_image('VAL_recon/epoch={:03}'.format(1), grid)
+            log_writer.add_image('VAL_recon/epoch={:03}'.format(1), grid.float())
         else:
             val_loss,_,_,default_slots_attns, dec_slots_attns,logits = model(image)
 
@@ -122,7 +261,7 @@ def gen_image(model, image, bsz, seed, num_iter=12, choice_temperature=4.5,per_i
             vis_recon = visualize(image_int, pred_dec_mask, pred_dec_mask, rgb_dec_attns, pred_default_mask, rgb_default_attns, N=32)
             grid = vutils.make_grid(vis_recon, nrow=2*7 + 4, pad_value=0.2)[:, 2:-2, 2:-2]#anti gia 7 num_slots
             grid = F.interpolate(grid.unsqueeze(1), scale_factor=0.15, mode='bilinear').squeeze() # Lower resolution
-            log_writer.add_image('VAL_recon/epoch={:03}'.format(1), grid)
+            log_writer.add_image('VAL_recon/epoch={:03}'.format(1), grid.float())
 
     
 
@@ -146,7 +285,7 @@ def gen_image(model, image, bsz, seed, num_iter=12, choice_temperature=4.5,per_i
 
     # Assuming 'your_slots_tensor' is your slots tensor with shape [images, num_slots, 256]
     slots_tensor = slots  # Replace with your actual tensor
-    slots_2d = slots_tensor.reshape(-1, 768).cpu().numpy()  # Reshape to 2D for prediction
+    slots_2d = slots_tensor.reshape(-1, 768).float().cpu().numpy()  # Reshape to 2D for prediction
 
     # Predict cluster assignments
     cluster_assignments = kmeans.predict(slots_2d)
@@ -161,29 +300,41 @@ def gen_image(model, image, bsz, seed, num_iter=12, choice_temperature=4.5,per_i
 
     # slots=model.slot_proj2(slots)
 
-    initial_token_indices = mask_token_id * torch.ones(bsz, unknown_number_in_the_beginning)
+    if decode_step is None:
+        decode_step = make_decode_step(model)
+    # per_iter / with_mask_vis decode the intermediate tokens every decode_every_k steps (default: last step only)
+    decode_every_k = decode_every_k or num_iter
 
-    token_indices = initial_token_indices.cuda()
+    # slots are fixed during decoding: project their cross-attention K/V once
+    slot_kv = model.project_slot_kv(slots)
 
-    for step in range(num_iter):
-        cur_ids = token_indices.clone().long()
+    buffers = get_buffers(bsz, unknown_number_in_the_beginning + 1,
+                          model.token_emb.word_embeddings.embedding_dim, image.device)
 
-        token_indices = torch.cat(
-            [torch.zeros(token_indices.size(0), 1).cuda(device=token_indices.device), token_indices], dim=1)
-        token_indices[:, 0] = model.fake_class_label
-        token_indices = token_indices.long()
-        token_all_mask = token_indices == mask_token_id
+    # [B, 257] buffer: class token at position 0, image tokens (initially all masked) after it
+    token_indices = buffers.token_indices
+    token_indices.fill_(mask_token_id)
+    token_indices[:, 0] = model.fake_class_label
 
-        token_drop_mask = torch.zeros_like(token_indices)
+    # token embedding, computed in full once and then only refreshed where tokens change
+    input_embeddings = buffers.input_embeddings
+    input_embeddings.copy_(model.token_emb(token_indices))
+    prev_token_indices = buffers.prev_token_indices
+    prev_token_indices.copy_(token_indices)
 
-        # token embedding
-        input_embeddings = model.token_emb(token_indices)
+    final_gen_images = None
+    for step in range(num_iter):
+        cur_ids = token_indices[:, 1:].clone()
 
-        # encoder
-        x = input_embeddings
-        for blk in model.blocks:
-            x = blk(x)
-        x = model.norm(x)
+        # masks live in persistent buffers: token_all_mask is refreshed in place, token_drop_mask is always zero
+        token_all_mask = torch.eq(token_indices, mask_token_id, out=buffers.token_all_mask)
+        token_drop_mask = buffers.token_drop_mask
+
+        input_embeddings = update_token_embeddings(model.token_emb, input_embeddings, token_indices, prev_token_indices)
+        prev_token_indices.copy_(token_indices)
+
+        # encoder + decoder
+        logits = decode_step(input_embeddings, slots, token_drop_mask, token_all_mask, slot_kv)
 
         
 
@@ -195,7 +346,7 @@ def gen_image(model, image, bsz, seed, num_iter=12, choice_temperature=4.5,per_i
 
         #     # Assuming 'your_slots_tensor' is your slots tensor with shape [images, num_slots, 256]
         #     slots_tensor = slots  # Replace with your actual tensor
-        #     slots_2d = slots_tensor.reshape(-1, 768).cpu().numpy()  # Reshape to 2D for prediction
+        #     slots_2d = slots_tensor.reshape(-1, 768).float().cpu().numpy()  # Reshape to 2D for prediction
 
         #     # Predict cluster assignments
         #     cluster_assignments = kmeans.predict(slots_2d)
@@ -235,19 +386,19 @@ def gen_image(model, image, bsz, seed, num_iter=12, choice_temperature=4.5,per_i
 
         # logits,_ = model.forward_decoder(x, slots_replaced, token_drop_mask, token_all_mask)
 
-        logits,_ = model.forward_decoder(x, slots, token_drop_mask, token_all_mask)
+        # logits,_ = model.forward_decoder(x, slots, token_drop_mask, token_all_mask)
         # logits = logits[:, model.slot_attention.num_slots+1:, :codebook_size]
 
 
 
         # decoder
         # logits,_ = model.forward_decoder(x, slots, token_drop_mask, token_all_mask)
-        logits = logits[:, model.slot_attention.num_slots+1:, :codebook_size]
+        logits = logits[:, model.slot_attention.num_slots+1:, :codebook_size].float()
         # logits = logits[:, n_top_slots+1:, :codebook_size]
 
-        # get token prediction
-        sample_dist = torch.distributions.categorical.Categorical(logits=logits)
-        sampled_ids = sample_dist.sample()
+        # get token prediction (Gumbel-max: argmax of logits + Gumbel noise samples from softmax(logits))
+        gumbel = torch.empty_like(logits).exponential_().log_().neg_()
+        sampled_ids = (logits + gumbel).argmax(dim=-1)
 
         # get ids for next step
         unknown_map = (cur_ids == mask_token_id)
@@ -260,103 +411,69 @@ def gen_image(model, image, bsz, seed, num_iter=12, choice_temperature=4.5,per_i
         print(mask_ratio)
 
         # sample ids according to prediction confidence
-        probs = torch.nn.functional.softmax(logits, dim=-1)
-        selected_probs = torch.squeeze(
-            torch.gather(probs, dim=-1, index=torch.unsqueeze(sampled_ids, -1)), -1)
+        log_probs = torch.log_softmax(logits, dim=-1)
+        selected_log_probs = torch.squeeze(
+            torch.gather(log_probs, dim=-1, index=torch.unsqueeze(sampled_ids, -1)), -1)
 
-        selected_probs = torch.where(unknown_map, selected_probs.double(), _CONFIDENCE_OF_KNOWN_TOKENS).float()
+        selected_log_probs = torch.where(unknown_map, selected_log_probs, _CONFIDENCE_OF_KNOWN_TOKENS)
 
-        mask_len = torch.Tensor([np.floor(unknown_number_in_the_beginning * mask_ratio)]).cuda()
+        mask_len = int(np.floor(unknown_number_in_the_beginning * mask_ratio))
         # Keeps at least one of prediction in this round and also masks out at least
         # one and for the next iteration
-        mask_len = torch.maximum(torch.Tensor([1]).cuda(),
-                                 torch.minimum(torch.sum(unknown_map, dim=-1, keepdims=True) - 1, mask_len))
+        mask_len = (torch.sum(unknown_map, dim=-1, keepdims=True) - 1).clamp(max=mask_len).clamp(min=1)
 
         # Sample masking tokens for next iteration
-        masking = mask_by_random_topk(mask_len[0], selected_probs, choice_temperature * (1 - ratio))
+        masking = mask_by_random_topk(mask_len[0], selected_log_probs, choice_temperature * (1 - ratio))
         # Masks tokens with lower confidence.
-        token_indices = torch.where(masking, mask_token_id, sampled_ids)
+        token_indices[:, 1:] = torch.where(masking, mask_token_id, sampled_ids)
 
   
 
-        if(with_mask_vis):
+        if (per_iter or with_mask_vis) and (step + 1) % decode_every_k == 0:
             batch_size=args.batch_size
 
-            # Assuming token_indices is of shape [32, 256] with 2024 indicating masks
-            batch_size, hw = token_indices.shape  # hw is 256 in your case
-
-            # Generate a boolean mask for where token_indices equals 2024
-            mask = token_indices == 2024
-
-
-            # Reshape mask to [batch_size, 1, 16, 16] for interpolation
-            mask = mask.view(batch_size, 1, 16, 16)
-
-            # Interpolate mask to [batch_size, 1, 256, 256]
-            mask_upsampled = F.interpolate(mask.float(), size=(256, 256), mode='nearest').bool()
-
-            # Expand mask to match image channels (assuming RGB, so repeat 3 times across dim=1)
-            mask_upsampled = mask_upsampled.expand(-1, 3, -1, -1)
-
-            
-
             # #Save images every iteration
             # probabilities = torch.nn.functional.softmax(logits, dim=-1)
             # reconstructed_indices = torch.argmax(probabilities, dim=-1)
             reconstructed_indices = sampled_ids
-            # Correctly replace masked indices in reconstructed_indices with 1023
-            # print(reconstructed_indices)
-            # reconstructed_indices = torch.where(token_indices == 2024, torch.tensor(0, device=token_indices.device), reconstructed_indices)
-            # print(reconstructed_indices)
-
-            z_q = model.vqgan.quantize.get_codebook_entry(reconstructed_indices, shape=(batch_size, 16, 16, codebook_emb_dim))
-            gen_images_batch = model.vqgan.decode(z_q)
-
-            # Assuming gen_images_batch is the tensor [batch_size, 3, 256, 256] from VQGAN's decode
-            # Set pixels to black (0) where mask_upsampled is True
-            gen_images_batch[mask_upsampled] = 0
-
-            # Save images
-            for b_id in range(batch_size):
-                # Apply inverse normalization
-                # inv_gen_img = inv_normalize(gen_images_batch[b_id])
-                inv_gen_img=gen_images_batch[b_id]
-                # inv_orig_img = inv_normalize(orig_images_batch[b_id])
-
-                # Convert to numpy and save - Generated Image
-                gen_img_np = np.clip(inv_gen_img.cpu().numpy().transpose(1, 2, 0) * 255, 0, 255).astype(np.uint8)
-                gen_img_np = cv2.cvtColor(gen_img_np, cv2.COLOR_RGB2BGR)
-                cv2.imwrite(os.path.join(save_folder, '{}.png'.format(str(b_id + 100*step).zfill(4))), gen_img_np)
-
-        if(per_iter):
-            batch_size=args.batch_size
-
-            # #Save images every iteration
-            # probabilities = torch.nn.functional.softmax(logits, dim=-1)
-            # reconstructed_indices = torch.argmax(probabilities, dim=-1)
-            # Correctly replace masked indices in reconstructed_indices with 1023
-            # print(reconstructed_indices)
-            # print(reconstructed_indices)
-            reconstructed_indices = sampled_ids
-            z_q = model.vqgan.quantize.get_codebook_entry(reconstructed_indices, shape=(batch_size, 16, 16, codebook_emb_dim))
-            gen_images_batch = model.vqgan.decode(z_q)
-
-            # Save images
-            for b_id in range(batch_size):
-                # Apply inverse normalization
-                # inv_gen_img = inv_normalize(gen_images_batch[b_id])
-                inv_gen_img=gen_images_batch[b_id]
-                # inv_orig_img = inv_normalize(orig_images_batch[b_id])
-
-                # Convert to numpy and save - Generated Image
-                gen_img_np = np.clip(inv_gen_img.cpu().numpy().transpose(1, 2, 0) * 255, 0, 255).astype(np.uint8)
-                gen_img_np = cv2.cvtColor(gen_img_np, cv2.COLOR_RGB2BGR)
-                cv2.imwrite(os.path.join(save_folder, '{}.png'.format(str(b_id + 1000000*step).zfill(5))), gen_img_np)
+            # One VQGAN decode shared by both visualizations
+            gen_images_batch = decode_tokens(model, reconstructed_indices, codebook_emb_dim, decode_batch_size)
+            if step == num_iter - 1:
+                # same sampled_ids as the final output, no need to decode them again
+                final_gen_images = gen_images_batch
+
+            if(per_iter):
+                # Save images
+                save_images_async(gen_images_batch,
+                                  [os.path.join(save_folder, '{}.png'.format(str(b_id + 1000000*step).zfill(5))) for b_id in range(batch_size)],
+                                  vis_format=args.vis_format)
+
+            if(with_mask_vis):
+                # token_indices[:, 1:] is of shape [32, 256] with 2024 indicating masks
+                batch_size, hw = token_indices[:, 1:].shape  # hw is 256 in your case
+
+                # Generate a boolean mask for where token_indices equals 2024
+                mask = token_indices[:, 1:] == 2024
+
+
+                # Reshape mask to [batch_size, 1, 16, 1, 16, 1]: one entry per 16x16 pixel tile,
+                # broadcast over channels and the pixels inside each tile
+                mask = mask.view(batch_size, 1, 16, 1, 16, 1)
+
+                # Set pixels to black (0) in the tiles of masked tokens
+                masked_images_batch = gen_images_batch.reshape(batch_size, 3, 16, 16, 16, 16).masked_fill(mask, 0)
+                masked_images_batch = masked_images_batch.reshape(batch_size, 3, 256, 256)
+
+                # Save images
+                save_images_async(masked_images_batch,
+                                  [os.path.join(save_folder, '{}.png'.format(str(b_id + 100*step).zfill(4))) for b_id in range(batch_size)],
+                                  vis_format=args.vis_format)
         
 
     # vqgan visualization
-    z_q = model.vqgan.quantize.get_codebook_entry(sampled_ids, shape=(bsz, 16, 16, codebook_emb_dim))
-    gen_images = model.vqgan.decode(z_q)
+    if final_gen_images is not None:
+        return final_gen_images
+    gen_images = decode_tokens(model, sampled_ids, codebook_emb_dim, decode_batch_size)
     return gen_images
 
 
@@ -383,6 +500,23 @@ parser.add_argument('--vqgan_jax_strongaug', default='vqgan_jax_strongaug.ckpt',
                     help='dataset name')
 parser.add_argument('--log_dir', default='./output_dir',
                     help='path where to tensorboard log')
+parser.add_argument('--per_iter', default=False, type=bool_flag,
+                    help='save the decoded images of intermediate iterations')
+parser.add_argument('--with_mask_vis', default=False, type=bool_flag,
+                    help='save intermediate images with the still-masked tokens blacked out')
+parser.add_argument('--decode_every_k', default=None, type=int,
+                    help='decode intermediate iterations every k steps (default: last step only)')
+parser.add_argument('--vis_format', default='png', type=str, choices=['png', 'jpg'],
+                    help='format of the intermediate visualizations (fast PNG compression or JPEG)')
+parser.add_argument('--decode_batch_size', default=None, type=int,
+                    help='micro-batch size for VQGAN decoding (default: whole batch)')
+parser.add_argument('--bf16', default=True, type=bool_flag,
+                    help='run generation under bf16 autocast')
+parser.add_argument('--int8_codebook', default=False, type=bool_flag,
+                    help='look up VQGAN codebook entries from an INT8 copy of the codebook')
+parser.add_argument('--compile', default=False, type=bool_flag,
+                    help='torch.compile the per-iteration decode step (CUDA graphs); only pays off '
+                         'over many batches of a fixed size')
 
 
 
@@ -447,6 +581,13 @@ model.to(0)
 checkpoint = torch.load(args.ckpt, map_location='cpu')
 model.load_state_dict(checkpoint['model'])
 model.eval()
+for p in model.parameters():
+    p.requires_grad_(False)
+# NHWC conv kernels for the VQGAN (decode is the heaviest single op per batch)
+model.vqgan = model.vqgan.to(memory_format=torch.channels_last)
+if args.int8_codebook:
+    model.vqgan.quantize.quantize_codebook_int8()
+decode_step = make_decode_step(model, compile=args.compile)
 
 num_steps = args.num_images // args.batch_size + 1
 gen_img_list = []
@@ -459,7 +600,8 @@ val_sampler = None
 
 if args.dataset == 'coco':
   val_dataset = COCO2017(root=args.data_path, split='val', image_size=256, mask_size=256)
-  val_loader = torch.utils.data.DataLoader(val_dataset, sampler=val_sampler, shuffle=False, drop_last=False, batch_size=args.batch_size, pin_memory=True,num_workers= 4)#,collate_fn=custom_collate_fn)
+  val_loader = torch.utils.data.DataLoader(val_dataset, sampler=val_sampler, shuffle=False, drop_last=False, batch_size=args.batch_size, pin_memory=True,num_workers= 4,
+                                           persistent_workers=True, prefetch_factor=4)#,collate_fn=custom_collate_fn)
 
 
 else:
@@ -476,14 +618,16 @@ else:
         num_workers=4,
         pin_memory=True,
         drop_last=True,
+        persistent_workers=True,
+        prefetch_factor=4,
     )
 
 
 # Assuming args.dataset is defined somewhere in your code
 if args.dataset == 'coco':
-    iterator = enumerate(tqdm(val_loader))
+    iterator = enumerate(prefetch_to_cuda(tqdm(val_loader)))
 else:
-    iterator = enumerate(tqdm(data_loader_train))
+    iterator = enumerate(prefetch_to_cuda(tqdm(data_loader_train)))
 counter=0
 for batch, data in iterator:
     if args.dataset == 'coco':
@@ -491,26 +635,21 @@ for batch, data in iterator:
     else:
         image, _ = data
 
-    with torch.no_grad():
-        gen_images_batch = gen_image(model=model,image=image, bsz=args.batch_size, seed=batch, choice_temperature=args.temp, num_iter=args.num_iter, data_used=args.dataset,slot_vis=args.slot_vis)
+    with torch.inference_mode(), torch.autocast(device_type='cuda', dtype=torch.bfloat16, enabled=args.bf16):
+        gen_images_batch = gen_image(model=model,image=image, bsz=args.batch_size, seed=batch, choice_temperature=args.temp, num_iter=args.num_iter, data_used=args.dataset,slot_vis=args.slot_vis,decode_step=decode_step,
+                                     per_iter=args.per_iter, with_mask_vis=args.with_mask_vis,
+                                     decode_every_k=args.decode_every_k, decode_batch_size=args.decode_batch_size)
+        # save img; from the device tensors, so only the uint8 batches cross to the host
+        save_images_async(gen_images_batch,
+                          [os.path.join(save_folder, '{}.png'.format(str(batch*args.batch_size + b_id).zfill(5))) for b_id in range(args.batch_size)])
+        save_images_async(image,
+                          [os.path.join(args.output_dir, 'orig_{}.png'.format(str(batch*args.batch_size + b_id).zfill(5))) for b_id in range(args.batch_size)])
+
         gen_images_batch = gen_images_batch.detach().cpu()
         gen_img_list.append(gen_images_batch)
-
-        orig_images_batch=image.detach().cpu()
-        # save img
-        for b_id in range(args.batch_size):
-
-            gen_img = np.clip(gen_images_batch[b_id].numpy().transpose([1, 2, 0]) * 255, 0, 255)
-            gen_img = gen_img.astype(np.uint8)[:, :, ::-1]
-            cv2.imwrite(os.path.join(save_folder, '{}.png'.format(str(batch*args.batch_size + b_id).zfill(5))), gen_img)
-
-
-
-            inv_orig_img = orig_images_batch[b_id]
-            orig_img_np = np.clip(inv_orig_img.numpy().transpose(1, 2, 0) * 255, 0, 255).astype(np.uint8)
-            orig_img_np = cv2.cvtColor(orig_img_np, cv2.COLOR_RGB2BGR)
-            cv2.imwrite(os.path.join(args.output_dir, 'orig_{}.png'.format(str(batch*args.batch_size + b_id).zfill(5))), orig_img_np)
     if batch >0:
         break
 
+wait_for_writes()
+executor.shutdown(wait=True)
 log_writer.close()
@@ -98,8 +98,8 @@ def gen_image(model, image, bsz, seed, num_iter=12, choice_temperature=4.5,per_i
           logits = logits[:, 1:, :codebook_size]
 
         # get token prediction
-        sample_dist = torch.distributions.categorical.Categorical(logits=logits)
-        sampled_ids = sample_dist.sample()
+        probs = torch.nn.functional.softmax(logits, dim=-1)
+        sampled_ids = torch.multinomial(probs.reshape(-1, probs.size(-1)), num_samples=1).reshape(probs.shape[:-1])
 
         # get ids for next step
         unknown_map = (cur_ids == mask_token_id)
@@ -112,7 +112,6 @@ def gen_image(model, image, bsz, seed, num_iter=12, choice_temperature=4.5,per_i
         print(mask_ratio)
 
         # sample ids according to prediction confidence
-        probs = torch.nn.functional.softmax(logits, dim=-1)
         selected_probs = torch.squeeze(
             torch.gather(probs, dim=-1, index=torch.unsqueeze(sampled_ids, -1)), -1)
 
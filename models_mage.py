@@ -2,6 +2,7 @@ from functools import partial
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 from timm.models.vision_transformer import PatchEmbed, DropPath, Mlp
 
@@ -81,15 +82,9 @@ class LabelSmoothingCrossEntropy(nn.Module):
         super(LabelSmoothingCrossEntropy, self).__init__()
         assert smoothing < 1.0
         self.smoothing = smoothing
-        self.confidence = 1. - smoothing
 
     def forward(self, x: torch.Tensor, target: torch.Tensor) -> torch.Tensor:
-        logprobs = torch.nn.functional.log_softmax(x, dim=-1)
-        nll_loss = -logprobs.gather(dim=-1, index=target.unsqueeze(1))
-        nll_loss = nll_loss.squeeze(1)
-        smooth_loss = -logprobs.mean(dim=-1)
-        loss = self.confidence * nll_loss + self.smoothing * smooth_loss
-        return loss
+        return F.cross_entropy(x, target, reduction='none', label_smoothing=self.smoothing)
 
 
 class BertEmbeddings(nn.Module):
@@ -142,9 +137,7 @@ class MlmLayer(nn.Module):
         mlm_hidden = self.fc(x)
         mlm_hidden = self.gelu(mlm_hidden)
         mlm_hidden = self.ln(mlm_hidden)
-        word_embeddings = word_embeddings.transpose(0, 1)
-        logits = torch.matmul(mlm_hidden, word_embeddings)
-        logits = logits + self.bias
+        logits = F.linear(mlm_hidden, word_embeddings, self.bias.view(-1))
         return logits
 
 
@@ -313,11 +306,9 @@ class MaskedGenerativeEncoderViT(nn.Module):
         # print("Masekd num token:", torch.sum(token_indices == self.mask_token_label, dim=1))
 
         # concate class token
-        token_indices = torch.cat([torch.zeros(token_indices.size(0), 1).cuda(device=token_indices.device), token_indices], dim=1)
-        token_indices[:, 0] = self.fake_class_label
-        token_drop_mask = torch.cat([torch.zeros(token_indices.size(0), 1).cuda(), token_drop_mask], dim=1)
-        token_all_mask = torch.cat([torch.zeros(token_indices.size(0), 1).cuda(), token_all_mask], dim=1)
-        token_indices = token_indices.long()
+        token_indices = F.pad(token_indices.long(), (1, 0), value=self.fake_class_label)
+        token_drop_mask = F.pad(token_drop_mask, (1, 0), value=0.)
+        token_all_mask = F.pad(token_all_mask, (1, 0), value=0.)
         # bert embedding
         input_embeddings = self.token_emb(token_indices)
         # print("Input embedding shape:", input_embeddings.shape)
@@ -361,11 +352,9 @@ class MaskedGenerativeEncoderViT(nn.Module):
         # print("Masekd num token:", torch.sum(token_indices == self.mask_token_label, dim=1))
 
         # concate class token
-        token_indices = torch.cat([torch.zeros(token_indices.size(0), 1).cuda(device=token_indices.device), token_indices], dim=1)
-        token_indices[:, 0] = self.fake_class_label
-        token_drop_mask = torch.cat([torch.zeros(token_indices.size(0), 1).cuda(), token_drop_mask], dim=1)
-        token_all_mask = torch.cat([torch.zeros(token_indices.size(0), 1).cuda(), token_all_mask], dim=1)
-        token_indices = token_indices.long()
+        token_indices = F.pad(token_indices.long(), (1, 0), value=self.fake_class_label)
+        token_drop_mask = F.pad(token_drop_mask, (1, 0), value=0.)
+        token_all_mask = F.pad(token_all_mask, (1, 0), value=0.)
         #torch.Size([32, 257])
         # bert embedding
         input_embeddings = self.token_emb(token_indices)
@@ -401,11 +390,9 @@ class MaskedGenerativeEncoderViT(nn.Module):
         #print("Masekd num token after encoder:", torch.sum(token_indices == self.mask_token_label, dim=1))
 
         # concate class token
-        token_indices = torch.cat([torch.zeros(token_indices.size(0), 1).cuda(device=token_indices.device), token_indices], dim=1)
-        token_indices[:, 0] = self.fake_class_label
-        token_drop_mask = torch.cat([torch.zeros(token_indices.size(0), 1).cuda(), token_drop_mask], dim=1)
-        token_all_mask = torch.cat([torch.zeros(token_indices.size(0), 1).cuda(), token_all_mask], dim=1)
-        token_indices = token_indices.long()
+        token_indices = F.pad(token_indices.long(), (1, 0), value=self.fake_class_label)
+        token_drop_mask = F.pad(token_drop_mask, (1, 0), value=0.)
+        token_all_mask = F.pad(token_all_mask, (1, 0), value=0.)
 
         return x, gt_indices, token_drop_mask, token_all_mask
     
@@ -420,11 +407,9 @@ class MaskedGenerativeEncoderViT(nn.Module):
         else:
             mask_tokens = self.mask_token.repeat(token_all_mask.shape[0], token_all_mask.shape[1], 1)
 
-        # put undropped tokens into original sequence
-        x_after_pad = mask_tokens.clone()
-        x_after_pad[(1 - token_drop_mask).nonzero(as_tuple=True)] = x.reshape(x.shape[0] * x.shape[1], x.shape[2])
-        # set undropped but masked positions with mask
-        x_after_pad = torch.where(token_all_mask.unsqueeze(-1).bool(), mask_tokens, x_after_pad)
+        # no tokens are ever dropped (token_drop_mask is all zeros, see forward_encoder), so x already
+        # holds every position; set masked positions with mask
+        x_after_pad = torch.where(token_all_mask.unsqueeze(-1).bool(), mask_tokens, x)
 
         # add pos embed
         x = x_after_pad + self.decoder_pos_embed_learned
@@ -435,7 +420,7 @@ class MaskedGenerativeEncoderViT(nn.Module):
 
         x = self.decoder_norm(x)
 
-        word_embeddings = self.token_emb.word_embeddings.weight.data.detach()
+        word_embeddings = self.token_emb.word_embeddings.weight.detach()
         x = self.mlm_layer(x, word_embeddings)
         # print("Logits shape:", x.shape)
 
@@ -451,11 +436,9 @@ class MaskedGenerativeEncoderViT(nn.Module):
         else:
             mask_tokens = self.mask_token.repeat(token_all_mask.shape[0], token_all_mask.shape[1], 1)
 
-        # put undropped tokens into original sequence
-        x_after_pad = mask_tokens.clone()
-        x_after_pad[(1 - token_drop_mask).nonzero(as_tuple=True)] = x.reshape(x.shape[0] * x.shape[1], x.shape[2])
-        # set undropped but masked positions with mask
-        x_after_pad = torch.where(token_all_mask.unsqueeze(-1).bool(), mask_tokens, x_after_pad)
+        # no tokens are ever dropped (token_drop_mask is all zeros, see forward_encoder), so x already
+        # holds every position; set masked positions with mask
+        x_after_pad = torch.where(token_all_mask.unsqueeze(-1).bool(), mask_tokens, x)
 
         # add pos embed
         x = x_after_pad + self.decoder_pos_embed_learned
@@ -474,7 +457,7 @@ class MaskedGenerativeEncoderViT(nn.Module):
 
         x = self.decoder_norm(x)
 
-        word_embeddings = self.token_emb.word_embeddings.weight.data.detach()
+        word_embeddings = self.token_emb.word_embeddings.weight.detach()
         x = self.mlm_layer(x, word_embeddings)
         # print("Logits shape:", x.shape)
 
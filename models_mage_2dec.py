@@ -2,6 +2,7 @@ from functools import partial
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 from timm.models.vision_transformer import PatchEmbed, DropPath, Mlp
 
@@ -71,20 +72,32 @@ class MultiHeadAttention(nn.Module):
         self.proj_o = linear(d_model, d_model, bias=False, gain=gain)
     
     
-    def forward(self, q, k, v, attn_mask=None):
+    def project_kv(self, k, v):
+        """
+        k: batch_size x source_len x d_model
+        v: batch_size x source_len x d_model
+        return: (k, v) each batch_size x num_heads x source_len x head_dim
+        """
+        B, S, _ = k.shape
+        k = self.proj_k(k).view(B, S, self.num_heads, -1).transpose(1, 2)
+        v = self.proj_v(v).view(B, S, self.num_heads, -1).transpose(1, 2)
+        return k, v
+
+    def forward(self, q, k, v, attn_mask=None, kv=None):
         """
         q: batch_size x target_len x d_model
         k: batch_size x source_len x d_model
         v: batch_size x source_len x d_model
         attn_mask: target_len x source_len
+        kv: optional output of project_kv(k, v), reused when k/v are fixed across calls
         return: batch_size x target_len x d_model
         """
         B, T, _ = q.shape
-        _, S, _ = k.shape
         
         q = self.proj_q(q).view(B, T, self.num_heads, -1).transpose(1, 2)
-        k = self.proj_k(k).view(B, S, self.num_heads, -1).transpose(1, 2)
-        v = self.proj_v(v).view(B, S, self.num_heads, -1).transpose(1, 2)
+        if kv is None:
+            kv = self.project_kv(k, v)
+        k, v = kv
         
         q = q * (q.shape[-1] ** (-0.5))
         attn = torch.matmul(q, k.transpose(-1, -2))
@@ -121,7 +134,7 @@ class Block(nn.Module):
 
             self.mage_cross_attn = MultiHeadAttention(dim, num_heads, attn_drop)
 
-    def forward(self, x,slots=None, return_attention=False):
+    def forward(self, x,slots=None, return_attention=False, slot_kv=None):
         if return_attention:
             _, attn = self.attn(self.norm1(x))
             return attn
@@ -131,7 +144,7 @@ class Block(nn.Module):
             x = x + self.drop_path(y)
             if self.dec and self.cross_attn:
                 x_cross = self.encoder_decoder_attn_layer_norm(x)
-                x = x + self.mage_cross_attn(x_cross,slots,slots)
+                x = x + self.mage_cross_attn(x_cross,slots,slots,kv=slot_kv)
             x = x + self.drop_path(self.mlp(self.norm2(x)))
         return x
     
@@ -163,15 +176,9 @@ class LabelSmoothingCrossEntropy(nn.Module):
         super(LabelSmoothingCrossEntropy, self).__init__()
         assert smoothing < 1.0
         self.smoothing = smoothing
-        self.confidence = 1. - smoothing
 
     def forward(self, x: torch.Tensor, target: torch.Tensor) -> torch.Tensor:
-        logprobs = torch.nn.functional.log_softmax(x, dim=-1)
-        nll_loss = -logprobs.gather(dim=-1, index=target.unsqueeze(1))
-        nll_loss = nll_loss.squeeze(1)
-        smooth_loss = -logprobs.mean(dim=-1)
-        loss = self.confidence * nll_loss + self.smoothing * smooth_loss
-        return loss
+        return F.cross_entropy(x, target, reduction='none', label_smoothing=self.smoothing)
 
 
 class BertEmbeddings(nn.Module):
@@ -201,6 +208,11 @@ class BertEmbeddings(nn.Module):
 
         position_ids = self.position_ids[:, :seq_length]
 
+        return self.embed_positions(input_ids, position_ids)
+
+    def embed_positions(self, input_ids, position_ids):
+        # embeddings of input_ids placed at position_ids (broadcastable shapes); also used to
+        # re-embed only the changed tokens during iterative decoding
         inputs_embeds = self.word_embeddings(input_ids)
 
         position_embeddings = self.position_embeddings(position_ids)
@@ -224,9 +236,7 @@ class MlmLayer(nn.Module):
         mlm_hidden = self.fc(x)
         mlm_hidden = self.gelu(mlm_hidden)
         mlm_hidden = self.ln(mlm_hidden)
-        word_embeddings = word_embeddings.transpose(0, 1)
-        logits = torch.matmul(mlm_hidden, word_embeddings)
-        logits = logits + self.bias
+        logits = F.linear(mlm_hidden, word_embeddings, self.bias.view(-1))
         return logits
 
 
@@ -514,11 +524,9 @@ class MaskedGenerativeEncoderViT(nn.Module):
         # print("Masekd num token:", torch.sum(token_indices == self.mask_token_label, dim=1))
 
         # concate class token
-        token_indices = torch.cat([torch.zeros(token_indices.size(0), 1).cuda(device=token_indices.device), token_indices], dim=1)
-        token_indices[:, 0] = self.fake_class_label
-        token_drop_mask = torch.cat([torch.zeros(token_indices.size(0), 1).cuda(), token_drop_mask], dim=1)
-        token_all_mask = torch.cat([torch.zeros(token_indices.size(0), 1).cuda(), token_all_mask], dim=1)
-        token_indices = token_indices.long()
+        token_indices = F.pad(token_indices.long(), (1, 0), value=self.fake_class_label)
+        token_drop_mask = F.pad(token_drop_mask, (1, 0), value=0.)
+        token_all_mask = F.pad(token_all_mask, (1, 0), value=0.)
         # bert embedding
         input_embeddings = self.token_emb(token_indices)
         # print("Input embedding shape:", input_embeddings.shape)
@@ -560,11 +568,9 @@ class MaskedGenerativeEncoderViT(nn.Module):
         # print("Masekd num token:", torch.sum(token_indices == self.mask_token_label, dim=1))
 
         # concate class token
-        token_indices = torch.cat([torch.zeros(token_indices.size(0), 1).cuda(device=token_indices.device), token_indices], dim=1)
-        token_indices[:, 0] = self.fake_class_label
-        token_drop_mask = torch.cat([torch.zeros(token_indices.size(0), 1).cuda(), token_drop_mask], dim=1)
-        token_all_mask = torch.cat([torch.zeros(token_indices.size(0), 1).cuda(), token_all_mask], dim=1)
-        token_indices = token_indices.long()
+        token_indices = F.pad(token_indices.long(), (1, 0), value=self.fake_class_label)
+        token_drop_mask = F.pad(token_drop_mask, (1, 0), value=0.)
+        token_all_mask = F.pad(token_all_mask, (1, 0), value=0.)
         #torch.Size([32, 257])
         # bert embedding
         input_embeddings = self.token_emb(token_indices)
@@ -600,11 +606,9 @@ class MaskedGenerativeEncoderViT(nn.Module):
         #print("Masekd num token after encoder:", torch.sum(token_indices == self.mask_token_label, dim=1))
 
         # concate class token
-        token_indices = torch.cat([torch.zeros(token_indices.size(0), 1).cuda(device=token_indices.device), token_indices], dim=1)
-        token_indices[:, 0] = self.fake_class_label
-        token_drop_mask = torch.cat([torch.zeros(token_indices.size(0), 1).cuda(), token_drop_mask], dim=1)
-        token_all_mask = torch.cat([torch.zeros(token_indices.size(0), 1).cuda(), token_all_mask], dim=1)
-        token_indices = token_indices.long()
+        token_indices = F.pad(token_indices.long(), (1, 0), value=self.fake_class_label)
+        token_drop_mask = F.pad(token_drop_mask, (1, 0), value=0.)
+        token_all_mask = F.pad(token_all_mask, (1, 0), value=0.)
 
         return x, gt_indices, token_drop_mask, token_all_mask
 
@@ -619,11 +623,7 @@ class MaskedGenerativeEncoderViT(nn.Module):
         token_indices = token_indices.reshape(z_q.size(0), -1)
 
         # concate class token
-        token_indices = token_indices.cuda()
-        token_indices = torch.cat(
-            [torch.zeros(token_indices.size(0), 1).cuda(device=token_indices.device), token_indices], dim=1)
-        token_indices[:, 0] = self.fake_class_label#Na to dw auto
-        token_indices = token_indices.long()
+        token_indices = F.pad(token_indices.long(), (1, 0), value=self.fake_class_label)
         # bert embedding
         x = self.token_emb(token_indices)
         token_emb = x
@@ -645,11 +645,9 @@ class MaskedGenerativeEncoderViT(nn.Module):
         else:
             mask_tokens = self.mask_token.repeat(token_all_mask.shape[0], token_all_mask.shape[1], 1)
 
-        # put undropped tokens into original sequence
-        x_after_pad = mask_tokens.clone()
-        x_after_pad[(1 - token_drop_mask).nonzero(as_tuple=True)] = x.reshape(x.shape[0] * x.shape[1], x.shape[2])
-        # set undropped but masked positions with mask
-        x_after_pad = torch.where(token_all_mask.unsqueeze(-1).bool(), mask_tokens, x_after_pad)
+        # no tokens are ever dropped (token_drop_mask is all zeros, see forward_encoder), so x already
+        # holds every position; set masked positions with mask
+        x_after_pad = torch.where(token_all_mask.unsqueeze(-1).bool(), mask_tokens, x)
 
         # add pos embed
         x = x_after_pad + self.decoder_pos_embed_learned
@@ -660,13 +658,20 @@ class MaskedGenerativeEncoderViT(nn.Module):
 
         x = self.decoder_norm(x)
 
-        word_embeddings = self.token_emb.word_embeddings.weight.data.detach()
+        word_embeddings = self.token_emb.word_embeddings.weight.detach()
         x = self.mlm_layer(x, word_embeddings)
         # print("Logits shape:", x.shape)
 
         return x
 
-    def forward_decoder(self, x,slots, token_drop_mask, token_all_mask):
+    def project_slot_kv(self, slots):
+        # Cross-attention K/V of the slots for every decoder block. They only depend on the slots,
+        # so iterative decoding can compute them once and pass them to forward_decoder.
+        if not self.cross_attn:
+            return None
+        return [blk.mage_cross_attn.project_kv(slots, slots) for blk in self.decoder_blocks]
+
+    def forward_decoder(self, x,slots, token_drop_mask, token_all_mask, slot_kv=None):
         # embed tokens
         x = self.decoder_embed(x)
 
@@ -676,11 +681,9 @@ class MaskedGenerativeEncoderViT(nn.Module):
         else:
             mask_tokens = self.mask_token.repeat(token_all_mask.shape[0], token_all_mask.shape[1], 1)
 
-        # put undropped tokens into original sequence
-        x_after_pad = mask_tokens.clone()
-        x_after_pad[(1 - token_drop_mask).nonzero(as_tuple=True)] = x.reshape(x.shape[0] * x.shape[1], x.shape[2])
-        # set undropped but masked positions with mask
-        x_after_pad = torch.where(token_all_mask.unsqueeze(-1).bool(), mask_tokens, x_after_pad)
+        # no tokens are ever dropped (token_drop_mask is all zeros, see forward_encoder), so x already
+        # holds every position; set masked positions with mask
+        x_after_pad = torch.where(token_all_mask.unsqueeze(-1).bool(), mask_tokens, x)
 
         # add pos embed
         x = x_after_pad + self.decoder_pos_embed_learned
@@ -697,17 +700,18 @@ class MaskedGenerativeEncoderViT(nn.Module):
 
 
         for i, blk in enumerate(self.decoder_blocks):
+            blk_slot_kv = slot_kv[i] if slot_kv is not None else None
             if i == len(self.decoder_blocks) - 1: # last block
                 # Get attention matrix from last block
                 with torch.no_grad(): # r
                     atts = blk(x,slots=slots_for_dec, return_attention=True)
-            x = blk(x,slots=slots_for_dec)
+            x = blk(x,slots=slots_for_dec, slot_kv=blk_slot_kv)
 
         
 
         x = self.decoder_norm(x)
 
-        word_embeddings = self.token_emb.word_embeddings.weight.data.detach()
+        word_embeddings = self.token_emb.word_embeddings.weight.detach()
         x = self.mlm_layer(x, word_embeddings)
         # print("Logits shape:", x.shape)
 
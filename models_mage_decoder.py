@@ -2,6 +2,8 @@ from functools import partial
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 
 from timm.models.vision_transformer import PatchEmbed, DropPath, Mlp
 
@@ -14,6 +16,25 @@ import scipy.stats as stats
 from slot_attn import SlotAttentionEncoder
 import math
 
+try:
+    from apex.normalization import FusedLayerNorm
+except ImportError:
+    FusedLayerNorm = nn.LayerNorm
+
+
+def layer_norm_cls(compiled):
+    # apex's fused kernel is an opaque extension call that dynamo cannot trace (a graph break per norm),
+    # so compiled models keep nn.LayerNorm and let Inductor fuse it. Note the precision differs under
+    # autocast: nn.LayerNorm runs in fp32, apex normalizes in the input dtype (bf16/fp16).
+    return nn.LayerNorm if compiled else FusedLayerNorm
+
+
+
+@torch.compile
+def _normalize_slot_attn(atts_slots, eps):
+    # epsilon + per-query normalization over slots, fused into a single kernel by Inductor
+    atts_slots = atts_slots + eps
+    return atts_slots / atts_slots.sum(dim=-1, keepdim=True)
 
 
 class Attention(nn.Module):
@@ -25,17 +46,29 @@ class Attention(nn.Module):
         self.scale = qk_scale or head_dim ** -0.5
 
         self.qkv = nn.Linear(dim, dim * 3, bias=qkv_bias)
+        self.attn_drop_p = attn_drop
         self.attn_drop = nn.Dropout(attn_drop)
         self.proj = nn.Linear(dim, dim)
         self.proj_drop = nn.Dropout(proj_drop)
 
-    def forward(self, x):
+    def forward(self, x, return_attention=False):
         B, N, C = x.shape
         qkv = self.qkv(x).reshape(B, N, 3, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
         q, k, v = qkv[0], qkv[1], qkv[2]   # make torchscript happy (cannot use tensor as tuple)
 
-        with torch.cuda.amp.autocast(enabled=False):
-            attn = (q.float() @ k.float().transpose(-2, -1)) * self.scale
+        if not return_attention:
+            # fused (Flash / memory-efficient) attention, the N x N matrix is never materialized
+            x = F.scaled_dot_product_attention(q.contiguous(), k.contiguous(), v.contiguous(),
+                                               dropout_p=self.attn_drop_p if self.training else 0.,
+                                               scale=self.scale)
+            x = x.transpose(1, 2).reshape(B, N, C)
+            x = self.proj(x)
+            x = self.proj_drop(x)
+            return x, None
+
+        # explicit path, only used when the attention map itself is needed; QK^T runs in the autocast
+        # precision, the max subtraction below keeps the softmax finite in bf16/fp16
+        attn = (q @ k.transpose(-2, -1)) * self.scale
 
         attn = attn - torch.max(attn, dim=-1, keepdim=True)[0]
         attn = attn.softmax(dim=-1)
@@ -46,6 +79,28 @@ class Attention(nn.Module):
         x = self.proj_drop(x)
         return x, attn
 
+    def forward_with_head_reduced_attn(self, x, query_start, slot_cols):
+        """
+        Fused attention output plus the attention of queries [query_start:] over the first
+        slot_cols keys, summed over heads: [B, N - query_start, slot_cols]. Only those query
+        rows are materialized, in the autocast precision, and no gradient flows through the map.
+        """
+        B, N, C = x.shape
+        qkv = self.qkv(x).reshape(B, N, 3, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
+        q, k, v = qkv[0], qkv[1], qkv[2]
+
+        with torch.no_grad():
+            attn = (q[:, :, query_start:] @ k.transpose(-2, -1)) * self.scale
+            attn = attn.softmax(dim=-1)[..., :slot_cols].sum(dim=1)
+
+        x = F.scaled_dot_product_attention(q.contiguous(), k.contiguous(), v.contiguous(),
+                                           dropout_p=self.attn_drop_p if self.training else 0.,
+                                           scale=self.scale)
+        x = x.transpose(1, 2).reshape(B, N, C)
+        x = self.proj(x)
+        x = self.proj_drop(x)
+        return x, attn
+
 
 class Block(nn.Module):
 
@@ -63,7 +118,7 @@ class Block(nn.Module):
 
     def forward(self, x, return_attention=False):
         if return_attention:
-            _, attn = self.attn(self.norm1(x))
+            _, attn = self.attn(self.norm1(x), return_attention=True)
             return attn
         else:
             y, _ = self.attn(self.norm1(x))
@@ -71,6 +126,13 @@ class Block(nn.Module):
             x = x + self.drop_path(self.mlp(self.norm2(x)))
         return x
 
+    def forward_split(self, x, query_start, slot_cols):
+        # single pass that returns both the block output and the head-summed slot attention
+        y, attn = self.attn.forward_with_head_reduced_attn(self.norm1(x), query_start, slot_cols)
+        x = x + self.drop_path(y)
+        x = x + self.drop_path(self.mlp(self.norm2(x)))
+        return x, attn
+
 
 class LabelSmoothingCrossEntropy(nn.Module):
     """ NLL loss with label smoothing.
@@ -79,28 +141,22 @@ class LabelSmoothingCrossEntropy(nn.Module):
         super(LabelSmoothingCrossEntropy, self).__init__()
         assert smoothing < 1.0
         self.smoothing = smoothing
-        self.confidence = 1. - smoothing
 
     def forward(self, x: torch.Tensor, target: torch.Tensor) -> torch.Tensor:
-        logprobs = torch.nn.functional.log_softmax(x, dim=-1)
-        nll_loss = -logprobs.gather(dim=-1, index=target.unsqueeze(1))
-        nll_loss = nll_loss.squeeze(1)
-        smooth_loss = -logprobs.mean(dim=-1)
-        loss = self.confidence * nll_loss + self.smoothing * smooth_loss
-        return loss
+        return F.cross_entropy(x, target, reduction='none', label_smoothing=self.smoothing)
 
 
 class BertEmbeddings(nn.Module):
     """Construct the embeddings from word, position and token_type embeddings."""
 
-    def __init__(self, vocab_size, hidden_size, max_position_embeddings, dropout=0.1):
+    def __init__(self, vocab_size, hidden_size, max_position_embeddings, dropout=0.1, norm_layer=nn.LayerNorm):
         super().__init__()
         self.word_embeddings = nn.Embedding(vocab_size, hidden_size)
         self.position_embeddings = nn.Embedding(max_position_embeddings, hidden_size)
 
         # self.LayerNorm is not snake-cased to stick with TensorFlow model variable name and be able to load
         # any TensorFlow checkpoint file
-        self.LayerNorm = nn.LayerNorm(hidden_size, eps=1e-6)
+        self.LayerNorm = norm_layer(hidden_size, eps=1e-6)
         self.dropout = nn.Dropout(dropout)
         # position_ids (1, len position emb) is contiguous in memory and exported when serialized
         self.register_buffer("position_ids", torch.arange(max_position_embeddings).expand((1, -1)))
@@ -129,20 +185,20 @@ class BertEmbeddings(nn.Module):
 
 class MlmLayer(nn.Module):
 
-    def __init__(self, feat_emb_dim, word_emb_dim, vocab_size):
+    def __init__(self, feat_emb_dim, word_emb_dim, vocab_size, norm_layer=nn.LayerNorm):
         super().__init__()
         self.fc = nn.Linear(feat_emb_dim, word_emb_dim)
         self.gelu = nn.GELU()
-        self.ln = nn.LayerNorm(word_emb_dim)
+        self.ln = norm_layer(word_emb_dim)
         self.bias = nn.Parameter(torch.zeros(1, 1, vocab_size))
 
     def forward(self, x, word_embeddings):
         mlm_hidden = self.fc(x)
         mlm_hidden = self.gelu(mlm_hidden)
         mlm_hidden = self.ln(mlm_hidden)
-        word_embeddings = word_embeddings.transpose(0, 1)
-        logits = torch.matmul(mlm_hidden, word_embeddings)
-        logits = logits + self.bias
+        # word_embeddings is [vocab_size, word_emb_dim], already the [out, in] layout F.linear expects;
+        # under autocast this is a single low-precision GEMM with the bias folded in
+        logits = F.linear(mlm_hidden, word_embeddings, self.bias.view(-1))
         return logits
 
 
@@ -154,10 +210,20 @@ class MaskedGenerativeEncoderViT(nn.Module):
                  decoder_embed_dim=512, decoder_depth=8, decoder_num_heads=16,
                  mlp_ratio=4., norm_layer=nn.LayerNorm, norm_pix_loss=False,
                  mask_ratio_min=0.5, mask_ratio_max=1.0, mask_ratio_mu=0.55, mask_ratio_std=0.25,epsilon=1e-8,
-                 vqgan_ckpt_path='vqgan_jax_strongaug.ckpt'):
+                 vqgan_ckpt_path='vqgan_jax_strongaug.ckpt', tie_mlm_weights=False, compile_blocks=False,
+                 checkpoint_decoder=False):
         super().__init__()
 
+        # TF32 matmuls/convs and the fused SDPA backends (flash, mem-efficient). The math backend stays
+        # enabled as fallback for inputs the fused kernels reject (e.g. fp32 flash on pre-Ampere GPUs).
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.allow_tf32 = True
+        torch.backends.cuda.enable_flash_sdp(True)
+        torch.backends.cuda.enable_mem_efficient_sdp(True)
+
         self.epsilon = epsilon
+        # BERT-style weight tying: let the MLM loss train the token embedding table
+        self.tie_mlm_weights = tie_mlm_weights
         # --------------------------------------------------------------------------
         # VQGAN specifics
         config = OmegaConf.load('config/vqgan.yaml').model
@@ -175,13 +241,19 @@ class MaskedGenerativeEncoderViT(nn.Module):
         self.token_emb = BertEmbeddings(vocab_size=vocab_size,
                                         hidden_size=embed_dim,
                                         max_position_embeddings=256+1,
-                                        dropout=0.1)
+                                        dropout=0.1,
+                                        norm_layer=layer_norm_cls(compile_blocks))
 
         # MAGE variant masking ratio
         self.mask_ratio_min = mask_ratio_min
         self.mask_ratio_generator = stats.truncnorm((mask_ratio_min - mask_ratio_mu) / mask_ratio_std,
                                                     (mask_ratio_max - mask_ratio_mu) / mask_ratio_std,
                                                     loc=mask_ratio_mu, scale=mask_ratio_std)
+        # truncnorm draws are taken from a host-side pool refilled in one vectorized rvs call, instead of
+        # paying the scipy call overhead every forward
+        self.mask_ratio_pool_size = 8192
+        self._mask_ratio_pool = np.empty(0)
+        self._mask_ratio_cursor = 0
 
         # --------------------------------------------------------------------------
         # MAGE encoder specifics
@@ -232,7 +304,8 @@ class MaskedGenerativeEncoderViT(nn.Module):
 
         # --------------------------------------------------------------------------
         # MlmLayer
-        self.mlm_layer = MlmLayer(feat_emb_dim=decoder_embed_dim, word_emb_dim=embed_dim, vocab_size=vocab_size)
+        self.mlm_layer = MlmLayer(feat_emb_dim=decoder_embed_dim, word_emb_dim=embed_dim, vocab_size=vocab_size,
+                                  norm_layer=layer_norm_cls(compile_blocks))
 
         self.norm_pix_loss = norm_pix_loss
 
@@ -240,6 +313,43 @@ class MaskedGenerativeEncoderViT(nn.Module):
 
         self.initialize_weights()
 
+        # set by freeze_encoder_decoder(), lets the forward skip autograd bookkeeping for frozen stacks
+        self._encoder_frozen = False
+        self._decoder_frozen = False
+
+        # run the block stacks through torch.compile (see run_encoder_blocks); opt-in, the first call
+        # pays a one-off compile
+        self.compile_blocks = compile_blocks
+        # recompute the frozen decoder's activations on backward instead of storing them (opt-in)
+        self.checkpoint_decoder = checkpoint_decoder
+
+    def run_encoder_blocks(self, x):
+        if self.compile_blocks:
+            return _compiled_encoder_blocks(self, x)
+        return self.forward_encoder_blocks(x)
+
+    def run_decoder_blocks(self, x, slots):
+        if self.compile_blocks:
+            return _compiled_decoder_blocks(self, x, slots)
+        return self.forward_decoder_blocks(x, slots)
+
+    def forward_encoder_blocks(self, x):
+        for blk in self.blocks:
+            x = blk(x)
+        return x
+
+    def forward_decoder_blocks(self, x, slots):
+        # pos-add and slot prefix are part of the block stack, so with compile_blocks Inductor fuses them
+        # with the concat copy and the first block's LayerNorm instead of materializing x + pos separately.
+        # The concat is lowered to two writes into one output buffer from Inductor's pool (no cat kernel,
+        # no extra allocation); keep it functional rather than copying into a persistent workspace,
+        # which autograd/checkpoint recomputation would see as an in-place overwrite
+        x = torch.cat((slots, x + self.decoder_pos_embed_learned), dim=1)
+        # all decoder blocks but the last one, which also produces the slot attention map
+        for blk in self.decoder_blocks[:-1]:
+            x = blk(x)
+        return x
+
     def initialize_weights(self):
         # initialization
         # initialize (and freeze) pos_embed by sin-cos embedding
@@ -267,7 +377,7 @@ class MaskedGenerativeEncoderViT(nn.Module):
             torch.nn.init.xavier_uniform_(m.weight)
             if isinstance(m, nn.Linear) and m.bias is not None:
                 nn.init.constant_(m.bias, 0)
-        elif isinstance(m, nn.LayerNorm):
+        elif isinstance(m, (nn.LayerNorm, FusedLayerNorm)):
             nn.init.constant_(m.bias, 0)
             nn.init.constant_(m.weight, 1.0)
 
@@ -283,77 +393,66 @@ class MaskedGenerativeEncoderViT(nn.Module):
         #token_indices 256,256,256.... batch size times
         #gt_indices torch.Size([32, 256])
 
-        # masking
         bsz, seq_len = token_indices.size()
 
-        token_drop_mask = torch.zeros(bsz, seq_len, device=x.device).float()  # No tokens are dropped
-        token_all_mask = torch.zeros(bsz, seq_len, device=x.device).float()    # Mask no tokens
-        #both torch.Size([32, 256])
-        token_indices[token_all_mask.nonzero(as_tuple=True)] = self.mask_token_label
-        # print("Masekd num token:", torch.sum(token_indices == self.mask_token_label, dim=1))
+        # the encoder sees all tokens: none are dropped or masked
+        token_drop_mask = torch.zeros(bsz, seq_len + 1, device=x.device)  # No tokens are dropped
 
         # concate class token
-        token_indices = torch.cat([torch.zeros(token_indices.size(0), 1).cuda(device=token_indices.device), token_indices], dim=1)
-        token_indices[:, 0] = self.fake_class_label
-        token_drop_mask = torch.cat([torch.zeros(token_indices.size(0), 1).cuda(), token_drop_mask], dim=1)
-        token_all_mask = torch.cat([torch.zeros(token_indices.size(0), 1).cuda(), token_all_mask], dim=1)
-        token_indices = token_indices.long()
+        token_indices = F.pad(token_indices.long(), (1, 0), value=self.fake_class_label)
         #torch.Size([32, 257])
-        # bert embedding
-        input_embeddings = self.token_emb(token_indices)
-        # print("Input embedding shape:", input_embeddings.shape)
-        bsz, seq_len, emb_dim = input_embeddings.shape
+        # A frozen encoder only needs an autograd graph if the token embedding below it still trains
+        encoder_needs_grad = not self._encoder_frozen or any(p.requires_grad for p in self.token_emb.parameters())
+        with torch.set_grad_enabled(torch.is_grad_enabled() and encoder_needs_grad):
+            # bert embedding
+            input_embeddings = self.token_emb(token_indices)
+            # print("Input embedding shape:", input_embeddings.shape)
 
-        # dropping
-        token_keep_mask = 1 - token_drop_mask
-        #input_embeddings_after_drop = input_embeddings[token_keep_mask.nonzero(as_tuple=True)].reshape(bsz, -1, emb_dim)
-        # print("Input embedding after drop shape:", input_embeddings_after_drop.shape)
+            # apply Transformer blocks
+            x = input_embeddings
 
-        # apply Transformer blocks
-        #x = input_embeddings_after_drop
-        x = input_embeddings
-
-        for blk in self.blocks:
-            x = blk(x)
+            x = self.run_encoder_blocks(x)
         x = self.norm(x)
         # print("Encoder representation shape:", x.shape)
+
         # Mask all tokens for the decoding phase
-        _, _, token_indices = token_tuple
-        token_indices = token_indices.reshape(z_q.size(0), -1)
-        gt_indices = token_indices.clone().detach().long()
+        token_all_mask = self.random_token_mask(bsz, seq_len, x.device)
 
-        # masking
-        bsz, seq_len = token_indices.size()
-        mask_ratio_min = self.mask_ratio_min
-        mask_rate = self.mask_ratio_generator.rvs(1)[0]
+        return x, gt_indices, token_drop_mask, token_all_mask
 
-        num_dropped_tokens = int(np.ceil(seq_len * mask_ratio_min))
-        num_masked_tokens = int(np.ceil(seq_len * mask_rate))
+    # The number of masked tokens changes every call; kept out of compiled graphs so it does not
+    # specialize (and recompile) them
+    @torch._dynamo.disable
+    def random_token_mask(self, bsz, seq_len, device):
+        mask_rate = self.sample_mask_rate()
 
-        # it is possible that two elements of the noise is the same, so do a while loop to avoid it
-        while True:
-            noise = torch.rand(bsz, seq_len, device=x.device)  # noise in [0, 1]
-            sorted_noise, _ = torch.sort(noise, dim=1)  # ascend: small is remove, large is keep
-            cutoff_mask = sorted_noise[:, num_masked_tokens-1:num_masked_tokens]
-            token_all_mask = (noise <= cutoff_mask).float()
-            if token_all_mask.sum() == bsz*num_masked_tokens:
-                break
-            else:
-                print("Rerandom the noise!")
-        # print(mask_rate, num_dropped_tokens, num_masked_tokens, token_drop_mask.sum(dim=1), token_all_mask.sum(dim=1))
-        token_indices[token_all_mask.nonzero(as_tuple=True)] = self.mask_token_label
-        # print("Masekd num token:", torch.sum(token_indices == self.mask_token_label, dim=1))
+        num_masked_tokens = int(np.ceil(seq_len * mask_rate))
 
-        # concate class token
-        token_indices = torch.cat([torch.zeros(token_indices.size(0), 1).cuda(device=token_indices.device), token_indices], dim=1)
-        token_indices[:, 0] = self.fake_class_label
-        # token_drop_mask = torch.cat([torch.zeros(token_indices.size(0), 1).cuda(), token_drop_mask], dim=1)
-        token_all_mask = torch.cat([torch.zeros(token_indices.size(0), 1).cuda(), token_all_mask], dim=1)
-        token_indices = token_indices.long()
+        # mask the num_masked_tokens positions with the smallest noise; topk + scatter gives exactly
+        # num_masked_tokens per row even with tied noise values, so no re-sampling (or host sync) is needed
+        noise = torch.rand(bsz, seq_len, device=device)  # noise in [0, 1]
+        _, masked_ids = torch.topk(noise, num_masked_tokens, dim=1, largest=False, sorted=False)
+        token_all_mask = torch.zeros_like(noise).scatter_(1, masked_ids, 1.0)
 
-        return x, gt_indices, token_drop_mask, token_all_mask
+        # class token is never masked
+        return F.pad(token_all_mask, (1, 0), value=0.)
     
 
+    def sample_mask_rate(self):
+        if self._mask_ratio_cursor >= len(self._mask_ratio_pool):
+            self._mask_ratio_pool = self.mask_ratio_generator.rvs(self.mask_ratio_pool_size)
+            self._mask_ratio_cursor = 0
+        mask_rate = self._mask_ratio_pool[self._mask_ratio_cursor]
+        self._mask_ratio_cursor += 1
+        return mask_rate
+
+    def mlm_word_embeddings(self):
+        # output projection of the MlmLayer, shared with the input token embedding
+        word_embeddings = self.token_emb.word_embeddings.weight
+        if not self.tie_mlm_weights:
+            word_embeddings = word_embeddings.detach()
+        return word_embeddings
+
     def forward_decoder_generation(self, x, token_drop_mask, token_all_mask):
         # embed tokens
         x = self.decoder_embed(x)
@@ -364,11 +463,9 @@ class MaskedGenerativeEncoderViT(nn.Module):
         else:
             mask_tokens = self.mask_token.repeat(token_all_mask.shape[0], token_all_mask.shape[1], 1)
 
-        # put undropped tokens into original sequence
-        x_after_pad = mask_tokens.clone()
-        x_after_pad[(1 - token_drop_mask).nonzero(as_tuple=True)] = x.reshape(x.shape[0] * x.shape[1], x.shape[2])
-        # set undropped but masked positions with mask
-        x_after_pad = torch.where(token_all_mask.unsqueeze(-1).bool(), mask_tokens, x_after_pad)
+        # no tokens are ever dropped (token_drop_mask is all zeros, see forward_encoder), so x already
+        # holds every position; set masked positions with mask
+        x_after_pad = torch.where(token_all_mask.unsqueeze(-1).bool(), mask_tokens, x)
 
         # add pos embed
         x = x_after_pad + self.decoder_pos_embed_learned
@@ -379,13 +476,33 @@ class MaskedGenerativeEncoderViT(nn.Module):
 
         x = self.decoder_norm(x)
 
-        word_embeddings = self.token_emb.word_embeddings.weight.data.detach()
+        word_embeddings = self.mlm_word_embeddings()
         x = self.mlm_layer(x, word_embeddings)
         # print("Logits shape:", x.shape)
 
         return x
 
     def forward_decoder(self, x,slots, token_drop_mask, token_all_mask):
+        # A frozen decoder still needs the autograd graph when gradients have to flow through it
+        # back to the slots (slot_attention trains) or the encoder output
+        decoder_needs_grad = not self._decoder_frozen or slots.requires_grad or x.requires_grad
+        with torch.set_grad_enabled(torch.is_grad_enabled() and decoder_needs_grad):
+            x, atts_slots = self._forward_decoder_blocks_with_slots(x, slots, token_drop_mask, token_all_mask)
+
+        x = self.decoder_norm(x)
+
+        word_embeddings = self.mlm_word_embeddings()
+        x = self.mlm_layer(x, word_embeddings)
+        # print("Logits shape:", x.shape)
+
+        #[32,256,7], already summed over heads
+        normalized_atts_slots = _normalize_slot_attn(atts_slots, self.epsilon)
+        #[32,256,7]
+
+        
+        return x,normalized_atts_slots
+
+    def _forward_decoder_blocks_with_slots(self, x, slots, token_drop_mask, token_all_mask):
         # embed tokens
         x = self.decoder_embed(x)
 
@@ -395,45 +512,29 @@ class MaskedGenerativeEncoderViT(nn.Module):
         else:
             mask_tokens = self.mask_token.repeat(token_all_mask.shape[0], token_all_mask.shape[1], 1)
 
-        # put undropped tokens into original sequence
-        x_after_pad = mask_tokens.clone()
-        x_after_pad[(1 - token_drop_mask).nonzero(as_tuple=True)] = x.reshape(x.shape[0] * x.shape[1], x.shape[2])
-        # set undropped but masked positions with mask
-        x_after_pad = torch.where(token_all_mask.unsqueeze(-1).bool(), mask_tokens, x_after_pad)
+        # no tokens are ever dropped (token_drop_mask is all zeros, see forward_encoder), so x already
+        # holds every position; set masked positions with mask
+        x_after_pad = torch.where(token_all_mask.unsqueeze(-1).bool(), mask_tokens, x)
 
-        # add pos embed
-        x = x_after_pad + self.decoder_pos_embed_learned
+        # A frozen decoder has no optimizer state and is cheap to re-run, so when gradients only pass
+        # through it (to the slots) recompute its activations on backward instead of storing them
+        use_checkpoint = self.checkpoint_decoder and self._decoder_frozen and torch.is_grad_enabled()
 
-        x = torch.cat((slots, x), dim=1)
-
-        # apply Transformer blocks
+        # add pos embed, prepend slots and apply Transformer blocks
         # for blk in self.decoder_blocks:
         #     x = blk(x)
-        for i, blk in enumerate(self.decoder_blocks):
-            if i == len(self.decoder_blocks) - 1: # last block
-                # Get attention matrix from last block
-                with torch.no_grad(): # r
-                    atts = blk(x, return_attention=True)
-            x = blk(x)
-
-        x = self.decoder_norm(x)
-
-        word_embeddings = self.token_emb.word_embeddings.weight.data.detach()
-        x = self.mlm_layer(x, word_embeddings)
-        # print("Logits shape:", x.shape)
-
-        #print(atts.shape)
-        #[32,16,264,264]
-        atts=atts.sum(dim=1)
-        atts_slots = atts[:,8:,:7]
-        atts_slots=atts_slots+self.epsilon
-        sums = atts_slots.sum(dim=2, keepdim=True)
-        # Replace zero sums to avoid division by zero
-        normalized_atts_slots = atts_slots / sums
-        #[32,256,7]
-
-        
-        return x,normalized_atts_slots
+        if use_checkpoint:
+            x = checkpoint(self.run_decoder_blocks, x_after_pad, slots, use_reentrant=False)
+        else:
+            x = self.run_decoder_blocks(x_after_pad, slots)
+        # Last block: output and slot attention map (queries after slots + cls, keys = slots) in one pass
+        num_slots = self.slot_attention.num_slots
+        if use_checkpoint:
+            x, atts_slots = checkpoint(self.decoder_blocks[-1].forward_split, x, num_slots + 1, num_slots,
+                                       use_reentrant=False)
+        else:
+            x, atts_slots = self.decoder_blocks[-1].forward_split(x, query_start=num_slots + 1, slot_cols=num_slots)
+        return x, atts_slots
 
 
     # [19:16:56.286655] 32
@@ -445,7 +546,7 @@ class MaskedGenerativeEncoderViT(nn.Module):
     def forward_loss(self, gt_indices, logits, mask):
         bsz, seq_len = gt_indices.size()
         # logits and mask are with seq_len+1 but gt_indices is with seq_len
-        loss = self.criterion(logits[:, 8:, :self.codebook_size].reshape(bsz*seq_len, -1), gt_indices.reshape(bsz*seq_len))#DEN EIMAI SIGOUROS GIA TO +1 H +7
+        loss = self.criterion(logits[:, self.slot_attention.num_slots+1:, :self.codebook_size].reshape(bsz*seq_len, -1), gt_indices.reshape(bsz*seq_len))#DEN EIMAI SIGOUROS GIA TO +1 H +7
         # loss = self.criterion(logits[:, 1:, :self.codebook_size].reshape(bsz*seq_len, -1), gt_indices.reshape(bsz*seq_len))#DEN EIMAI SIGOUROS GIA TO +1 H +7
 
         # print(loss.shape)
@@ -475,6 +576,8 @@ class MaskedGenerativeEncoderViT(nn.Module):
         return loss, imgs, token_all_mask,attn[:,1:,:],attn_dec,logits
 
     def freeze_encoder_decoder(self):
+        self._encoder_frozen = True
+        self._decoder_frozen = True
         # Freeze encoder
         self.cls_token.requires_grad = False
         for param in self.patch_embed.parameters():
@@ -497,24 +600,55 @@ class MaskedGenerativeEncoderViT(nn.Module):
             param.requires_grad = False
         # Add any other components as needed
 
+        # frozen blocks run without dropout from now on, see train()
+        self.train(self.training)
+
+    def train(self, mode=True):
+        super().train(mode)
+        # Frozen blocks cannot adapt to dropout, it would only add noise to the slot_attention inputs;
+        # keep them in eval mode (dropout off, SDPA dropout_p=0) even while the rest of the model trains
+        if self._encoder_frozen:
+            self.blocks.eval()
+        if self._decoder_frozen:
+            self.decoder_blocks.eval()
+        return self
+
+
+# Compiled once for the class, not per instance: the model is passed in explicitly, so deepcopy and
+# DataParallel replicas run their own blocks, and the module tree (checkpoint keys) is unchanged.
+# Shapes are static (img_size=256), so Inductor can fold bias-add, GELU and dropout into the GEMM epilogues.
+_compiled_encoder_blocks = torch.compile(MaskedGenerativeEncoderViT.forward_encoder_blocks, dynamic=False)
+_compiled_decoder_blocks = torch.compile(MaskedGenerativeEncoderViT.forward_decoder_blocks, dynamic=False)
+
+
+def compile_forward(model):
+    # whole-graph compile of the training forward (input is always [B, 3, 256, 256]); the per-stack
+    # compiles are inlined into it
+    model.forward = torch.compile(model.forward, dynamic=False, mode="max-autotune-no-cudagraphs")
+    return model
+
 
-def mage_vit_base_patch16(**kwargs):
+def mage_vit_base_patch16(compile=False, **kwargs):
     model = MaskedGenerativeEncoderViT(
         patch_size=16, embed_dim=768, depth=12, num_heads=12,
         decoder_embed_dim=768, decoder_depth=8, decoder_num_heads=16,
-        mlp_ratio=4, norm_layer=partial(nn.LayerNorm, eps=1e-6), **kwargs)
+        mlp_ratio=4, norm_layer=partial(layer_norm_cls(compile), eps=1e-6), compile_blocks=compile, **kwargs)
 
     model.freeze_encoder_decoder()
+    if compile:
+        compile_forward(model)
 
     return model
 
 
-def mage_vit_large_patch16(**kwargs):
+def mage_vit_large_patch16(compile=False, **kwargs):
     model = MaskedGenerativeEncoderViT(
         patch_size=16, embed_dim=1024, depth=24, num_heads=16,
         decoder_embed_dim=1024, decoder_depth=8, decoder_num_heads=16,
-        mlp_ratio=4, norm_layer=partial(nn.LayerNorm, eps=1e-6), **kwargs)
+        mlp_ratio=4, norm_layer=partial(layer_norm_cls(compile), eps=1e-6), compile_blocks=compile, **kwargs)
     
     model.freeze_encoder_decoder()
+    if compile:
+        compile_forward(model)
 
     return model
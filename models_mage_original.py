@@ -2,6 +2,7 @@ from functools import partial
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 from timm.models.vision_transformer import PatchEmbed, DropPath, Mlp
 
@@ -76,15 +77,9 @@ class LabelSmoothingCrossEntropy(nn.Module):
         super(LabelSmoothingCrossEntropy, self).__init__()
         assert smoothing < 1.0
         self.smoothing = smoothing
-        self.confidence = 1. - smoothing
 
     def forward(self, x: torch.Tensor, target: torch.Tensor) -> torch.Tensor:
-        logprobs = torch.nn.functional.log_softmax(x, dim=-1)
-        nll_loss = -logprobs.gather(dim=-1, index=target.unsqueeze(1))
-        nll_loss = nll_loss.squeeze(1)
-        smooth_loss = -logprobs.mean(dim=-1)
-        loss = self.confidence * nll_loss + self.smoothing * smooth_loss
-        return loss
+        return F.cross_entropy(x, target, reduction='none', label_smoothing=self.smoothing)
 
 
 class BertEmbeddings(nn.Module):
@@ -137,9 +132,7 @@ class MlmLayer(nn.Module):
         mlm_hidden = self.fc(x)
         mlm_hidden = self.gelu(mlm_hidden)
         mlm_hidden = self.ln(mlm_hidden)
-        word_embeddings = word_embeddings.transpose(0, 1)
-        logits = torch.matmul(mlm_hidden, word_embeddings)
-        logits = logits + self.bias
+        logits = F.linear(mlm_hidden, word_embeddings, self.bias.view(-1))
         return logits
 
 
@@ -289,11 +282,9 @@ class MaskedGenerativeEncoderViT(nn.Module):
         # print("Masekd num token:", torch.sum(token_indices == self.mask_token_label, dim=1))
 
         # concate class token
-        token_indices = torch.cat([torch.zeros(token_indices.size(0), 1).cuda(device=token_indices.device), token_indices], dim=1)
-        token_indices[:, 0] = self.fake_class_label
-        token_drop_mask = torch.cat([torch.zeros(token_indices.size(0), 1).cuda(), token_drop_mask], dim=1)
-        token_all_mask = torch.cat([torch.zeros(token_indices.size(0), 1).cuda(), token_all_mask], dim=1)
-        token_indices = token_indices.long()
+        token_indices = F.pad(token_indices.long(), (1, 0), value=self.fake_class_label)
+        token_drop_mask = F.pad(token_drop_mask, (1, 0), value=0.)
+        token_all_mask = F.pad(token_all_mask, (1, 0), value=0.)
         # bert embedding
         input_embeddings = self.token_emb(token_indices)
         # print("Input embedding shape:", input_embeddings.shape)
@@ -338,7 +329,7 @@ class MaskedGenerativeEncoderViT(nn.Module):
 
         x = self.decoder_norm(x)
 
-        word_embeddings = self.token_emb.word_embeddings.weight.data.detach()
+        word_embeddings = self.token_emb.word_embeddings.weight.detach()
         x = self.mlm_layer(x, word_embeddings)
         # print("Logits shape:", x.shape)
 
@@ -244,6 +244,24 @@ class VectorQuantizer2(nn.Module):
 
         self.sane_index_shape = sane_index_shape
 
+        # optional INT8 copy of the codebook used by get_codebook_entry, see quantize_codebook_int8
+        self.register_buffer("codebook_int8", None, persistent=False)
+        self.register_buffer("codebook_scale", None, persistent=False)
+        self.register_buffer("codebook_zero_point", None, persistent=False)
+
+    def quantize_codebook_int8(self):
+        """
+        One-shot per-channel min/max calibration of the codebook to INT8. Only the
+        lookup in get_codebook_entry uses it; encoding keeps the full precision codebook.
+        """
+        w = self.embedding.weight.detach().float()
+        w_min, w_max = w.min(dim=0).values, w.max(dim=0).values
+        scale = ((w_max - w_min) / 255.).clamp(min=1e-8)
+        zero_point = -128. - w_min / scale
+        self.codebook_int8 = torch.round(w / scale + zero_point).clamp(-128, 127).to(torch.int8)
+        self.codebook_scale = scale
+        self.codebook_zero_point = zero_point
+
     def remap_to_used(self, inds):
         ishape = inds.shape
         assert len(ishape)>1
@@ -319,7 +337,11 @@ class VectorQuantizer2(nn.Module):
             indices = indices.reshape(-1) # flatten again
 
         # get quantized latent vectors
-        z_q = self.embedding(indices)
+        if self.codebook_int8 is not None:
+            # gather INT8 rows, dequantize after the lookup
+            z_q = (self.codebook_int8[indices].float() - self.codebook_zero_point) * self.codebook_scale
+        else:
+            z_q = self.embedding(indices)
 
         if shape is not None:
             z_q = z_q.view(shape)